@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 
 import sys
-import time
-from queue import Queue
+from threading import Event
 from datetime import datetime
 
 import daemon
 
 from daqrunlogger import StdoutDAQRunLogger, ShellDAQRunLogger, \
-    DAQLoggerWorker, RunInfo
+    DAQLoggerPool, RunInfo
 
 
 def main():
@@ -18,29 +17,23 @@ def main():
     shelllogger = ShellDAQRunLogger('echo', ['run_number', 'start_time'])
     loggers = [stdoutlogger, shelllogger] #, gslogger]
 
-    queues = []
-    workers = []
-    for logger in loggers:
-        q = Queue()
-        w = DAQLoggerWorker(logger, q)
-        queues.append(q)
-        workers.append(w)
-
-        w.start()
-
-    print(f'Started with {len(workers)} workers.')
-    new_run = True
-    while True:
-        # check the DAQ log for new runs
-        if not new_run:
-            print('No new run, sleeping...')
-            time.sleep(1)
-            continue
-
-        # post the run to all the loggers
-        for q in queues:
-            q.put(RunInfo(17215, datetime.now(), 'bnbTest', end_time=datetime.now(), comments='test comment'))
-        new_run = False
+    pool = DAQLoggerPool(loggers)
+    print(f'Started with {len(loggers)} loggers.')
+
+    # the DAQ log scanner sets this whenever it finds a new run
+    new_run_event = Event()
+    new_run_event.set()
+    try:
+        while new_run_event.wait():
+            new_run_event.clear()
+
+            # post the run to all the loggers
+            info = RunInfo(17215, datetime.now(), 'bnbTest', 'metadata', end_time=datetime.now(), comments='test comment')
+            pool.submit(info)
+    finally:
+        # on SIGTERM (SystemExit from the daemon context) or ^C, don't lose
+        # runs still batched up in the loggers
+        pool.shutdown()
 
 
 if __name__ == '__main__':
@@ -1,6 +1,6 @@
 from .daqrunlogger import DAQRunLogger, StdoutDAQRunLogger, RunInfo
 from .shelldaqrunlogger import ShellDAQRunLogger, OnStartDAQRunLogger
-from .daqloggerworker import DAQLoggerWorker
+from .daqloggerworker import DAQLoggerWorker, DAQLoggerPool
 
 try:
     from googleapiclient.discovery import build
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+from threading import Lock, Timer
+from typing import Any, Callable, List, Optional
+
+
+class Batcher:
+    """Collects items and hands them to a flush callback in the order they
+    were added. A batch is flushed once max_size items are waiting, or wait
+    seconds after the most recent item was added."""
+    def __init__(self, flush_callback: Callable[[List[Any]], None], max_size: int=3, wait: float=2.0):
+        self._flush_callback = flush_callback
+        self._max_size = max_size
+        # in seconds
+        self._wait = wait
+
+        self._pending = []
+        self._timer: Optional[Timer] = None
+        # guards _pending and _timer
+        self._lock = Lock()
+        # only one flush runs at a time, so batches go out in order
+        self._flush_lock = Lock()
+
+    def add(self, item: Any) -> None:
+        with self._lock:
+            self._pending.append(item)
+            self._cancel_timer()
+
+            full = len(self._pending) >= self._max_size
+            if not full:
+                self._timer = Timer(self._wait, self.flush)
+                # don't hold up interpreter exit
+                self._timer.daemon = True
+                self._timer.start()
+
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Flush everything waiting right now."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._cancel_timer()
+
+            if batch:
+                self._flush_callback(batch)
+
+    def _cancel_timer(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 
 import time
-from queue import Queue
-from threading import Thread
+from queue import Queue, Empty
+from threading import Thread, Condition
 from datetime import datetime
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 from .daqrunlogger import RunInfo, DAQRunLogger
 
+import logging
+logger = logging.getLogger(__name__)
+
 
 
 class DAQLoggerWorker(Thread):
@@ -26,14 +33,21 @@ class DAQLoggerWorker(Thread):
     
     def stop(self):
         self._stopped = True
+        # wake the worker up if it is blocked waiting on the queue
+        self._queue.put(None)
 
     def run(self):
         while not self._stopped:
-            if self._queue.empty():
-                time.sleep(self._timeout)
+            try:
+                info = self._queue.get(timeout=self._timeout)
+            except Empty:
+                continue
+
+            if info is None:
+                # sentinel from stop()
+                self._queue.task_done()
                 continue
 
-            info = self._queue.get()
             if not self._logger.filter_run(info):
                 self._queue.task_done()
                 continue
@@ -42,6 +56,164 @@ class DAQLoggerWorker(Thread):
             self._queue.task_done()
 
 
+class DAQLoggerPool:
+    """Hands RunInfo objects to a set of DAQRunLoggers using one shared thread
+    pool instead of a thread per logger. Each logger sees runs in the order
+    they were submitted, and never handles more than one run at a time.
+
+    submit() only puts the run on a queue; a single scheduler thread takes
+    it from there and dispatches it to the pool.
+
+    A logger with SUPPORTS_BATCH = True and a batch_log_runs(infos) method
+    gets a backlog of runs that piled up while it was busy in one call, after
+    filtering each of them."""
+    def __init__(self, loggers: List[DAQRunLogger], max_workers: int=0):
+        self._loggers = list(loggers)
+        self._executor = ThreadPoolExecutor(
+                max_workers=max_workers or max(len(self._loggers), 1),
+                thread_name_prefix='DAQLoggerPool')
+
+        # each run is published once into a shared log. Every logger keeps a
+        # cursor, the sequence number of the next run it will handle, and a
+        # flag for whether a pool thread is currently draining it
+        self._runs = deque()
+        self._first_seq = 0
+        self._next_seq = 0
+        self._cursors = [0] * len(self._loggers)
+        self._busy = [False] * len(self._loggers)
+        self._cond = Condition()
+
+        self._queue = Queue()
+        self._scheduler = Thread(target=self._dispatch_loop, name='DAQLoggerPool-scheduler')
+        # this thread will exit once the main thread does
+        self._scheduler.daemon = True
+        self._scheduler.start()
+
+    def submit(self, info: RunInfo) -> None:
+        self._queue.put(info)
+
+    def join(self) -> None:
+        """Block until every logger has handled every submitted run."""
+        self._queue.join()
+        with self._cond:
+            self._cond.wait_for(lambda: not any(self._busy))
+
+    def shutdown(self, wait: bool=True) -> None:
+        """Stop taking runs. With wait, finish every submitted run and then
+        push out anything the loggers still hold: flush() queued posts, or
+        close() a logger that has it (persistent shell commands). Without
+        wait, runs already submitted are still handed to the pool, but this
+        doesn't wait for the loggers to finish them."""
+        # sentinel for the scheduler. Always let it publish what is queued
+        # ahead of the sentinel: it submits to the executor, which can't take
+        # new work once shut down
+        self._queue.put(None)
+        self._scheduler.join()
+        self._executor.shutdown(wait=wait)
+        if not wait:
+            return
+
+        for run_logger in self._loggers:
+            # close() flushes too, where a logger has both
+            finish = getattr(run_logger, 'close', None) or getattr(run_logger, 'flush', None)
+            if finish is None:
+                continue
+            try:
+                finish()
+            except Exception as e:
+                logger.exception(e)
+
+    def _dispatch_loop(self) -> None:
+        while True:
+            info = self._queue.get()
+            if info is None:
+                self._queue.task_done()
+                return
+
+            self._publish(info)
+            self._queue.task_done()
+
+    def _publish(self, info: RunInfo) -> None:
+        with self._cond:
+            self._runs.append(info)
+            self._next_seq += 1
+            idle = [i for i, busy in enumerate(self._busy) if not busy]
+            for i in idle:
+                self._busy[i] = True
+
+        # an idle logger has nothing in flight, so it is safe to filter here
+        # and only hand accepted runs to the pool. Busy loggers filter their
+        # backlog themselves in _drain to keep filter_run/log_run ordered
+        for i in idle:
+            try:
+                accepted = self._loggers[i].filter_run(info)
+            except Exception as e:
+                logger.exception(e)
+                accepted = False
+
+            if accepted:
+                self._executor.submit(self._drain, i, info)
+                continue
+
+            # only this thread publishes, so nothing else can be waiting
+            with self._cond:
+                self._advance(i)
+                self._busy[i] = False
+                self._cond.notify_all()
+
+    def _advance(self, i: int) -> None:
+        """Move logger i past its current run. Call with _cond held."""
+        self._cursors[i] += 1
+        # forget runs every logger is done with
+        while self._runs and min(self._cursors) > self._first_seq:
+            self._runs.popleft()
+            self._first_seq += 1
+
+    def _drain(self, i: int, info: RunInfo) -> None:
+        """Log a run that already passed filter_run, then work through any
+        runs published for this logger in the meantime."""
+        run_logger = self._loggers[i]
+        batch_log_runs = None
+        if getattr(run_logger, 'SUPPORTS_BATCH', False):
+            batch_log_runs = run_logger.batch_log_runs
+        try:
+            run_logger.log_run(info)
+        except Exception as e:
+            logger.exception(e)
+
+        while True:
+            with self._cond:
+                self._advance(i)
+                if self._cursors[i] == self._next_seq:
+                    self._busy[i] = False
+                    self._cond.notify_all()
+                    return
+
+                start = self._cursors[i] - self._first_seq
+                if batch_log_runs is None:
+                    infos = [self._runs[start]]
+                else:
+                    # take the whole backlog; the cursor stays on its last run
+                    infos = list(islice(self._runs, start, None))
+                    self._cursors[i] = self._next_seq - 1
+
+            accepted = []
+            for info in infos:
+                try:
+                    if run_logger.filter_run(info):
+                        accepted.append(info)
+                except Exception as e:
+                    logger.exception(e)
+
+            try:
+                if len(accepted) > 1:
+                    batch_log_runs(accepted)
+                elif accepted:
+                    run_logger.log_run(accepted[0])
+            except Exception as e:
+                logger.exception(e)
+
+
 if __name__ == '__main__':
     from DAQRunLogger import StdoutDAQRunLogger
     info_queue = Queue()
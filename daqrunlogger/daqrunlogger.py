@@ -4,13 +4,17 @@
 Classes to automate logging DAQ runs to different services: ECL & Google sheets
 """
 
+import sys
 from dataclasses import dataclass, field
 from typing import List, Protocol, Optional
 from datetime import datetime
 
 
+# dataclasses only learned to generate __slots__ in python 3.10
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
 
-@dataclass
+
+@dataclass(frozen=True, **_SLOTS)
 class RunInfo:
     run_number: int
     start_time: datetime
@@ -36,6 +40,10 @@ class StdoutDAQRunLogger:
     def __init__(self):
         pass
 
+    def filter_run(self, info: RunInfo) -> bool:
+        """Accept any run."""
+        return True
+
     def log_run(self, info: RunInfo) -> None:
         print(info)
 
@@ -1,20 +1,75 @@
 #!/usr/bin/env python3
 
+import os
 import time
 import dataclasses
+import functools
 
-from typing import Optional
+from typing import Optional, List, Tuple
+from threading import RLock
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from collections import deque
-import xml.etree.ElementTree as ET
 
+try:
+    # libxml2-backed parser, much faster for large search responses
+    from lxml import etree as ET
+    # tolerate minor markup problems in the html fragments of ECL entries
+    _FRAGMENT_PARSER = ET.XMLParser(recover=True)
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _FRAGMENT_PARSER = None
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import ecl_api.ecl
 from ecl_api import ECL, ECLEntry
 
 from .daqrunlogger import RunInfo
+from .batcher import Batcher
+from .ratelimiter import TokenBucket
+from .runcache import RunCache
 
 import logging
 logger = logging.getLogger(__name__)
 
+# form fields for each kind of post. _post_run copies these so every post
+# reuses the same key layout instead of building it from scratch
+_START_FIELDS_PROTOTYPE = dict.fromkeys(
+        ('number', 'start_time', 'configuration', 'included_components', 'metadata'), '')
+_END_FIELDS_PROTOTYPE = dict.fromkeys(
+        ('number', 'end_time', 'crashed', 'duration'), '')
+
+
+@functools.lru_cache(maxsize=8)
+def _read_password(password_file: str, mtime: float) -> str:
+    """Read the ECL password. mtime is only part of the cache key, so an
+    edited file gets re-read."""
+    with open(password_file, 'r', buffering=-1) as f:
+        return f.readline().strip()
+
+
+class _SessionRequests:
+    """Stands in for the requests module inside ecl_api, which has no session
+    hook of its own, so every ECL call reuses one keep-alive Session."""
+    exceptions = requests.exceptions
+
+    def __init__(self, session: requests.Session):
+        self.get = session.get
+        self.post = session.post
+
+
+def _use_pooled_session() -> None:
+    """Route all ECL requests in this process through a pooled Session."""
+    if isinstance(ecl_api.ecl.requests, _SessionRequests):
+        return
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    ecl_api.ecl.requests = _SessionRequests(session)
+
 
 class ECLDAQRunLogger:
     """Posts run info to the E-Log."""
@@ -22,109 +77,202 @@ class ECLDAQRunLogger:
     ECL_CATEGORY = 'DAQ/Automation'
     ECL_START_FORM = 'Run Start'
     ECL_END_FORM = 'Run End'
-
-    def __init__(self, ecl_url, username, password_file='ecl_pwd.txt', min_run=0):
+    # indexed by end_of_run
+    ECL_FORMS = (ECL_START_FORM, ECL_END_FORM)
+    ECL_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    # reuse a search response for this long, matching the posting rate limit
+    ECL_SEARCH_TTL = 30
+    # path to our start-of-run entries in an ECL search response
+    ECL_START_ENTRIES = f"./entry[@form='{ECL_START_FORM}']"
+
+    # shared by all instances: one post batch per 30 seconds on average, with
+    # room for an end-of-run and a start-of-run batch back to back
+    _rate_limiter = TokenBucket(rate=1/30, burst=2)
+
+    def __init__(self, ecl_url, username, password_file='ecl_pwd.txt', min_run=0, batch_size=3, batch_wait=2.0):
         self._ecl_url = ecl_url
-        self._last_posted_time = datetime.fromtimestamp(0)
-
         # (optional) extra precaution: Don't post if the run is older than this
         self._min_run = min_run
 
-        with open(password_file, 'r') as f:
-            password = f.readlines()[0].strip()
+        password = _read_password(password_file, os.stat(password_file).st_mtime)
+        # before constructing ECL, which already makes requests
+        _use_pooled_session()
         self._ecl_service = ECL(url=self._ecl_url, user=username, password=password)
 
         self._current_run = None
-        self._run_cache = deque(maxlen=1000)
+        # runs we are done with, so we can skip duplicates
+        self._run_cache = RunCache(maxlen=1000)
+        # (monotonic time of the search, response)
+        self._search_cache = (0.0, None)
+        # run number -> ECL entry id of its start-of-run post, as seen in searches
+        self._start_entry_ids = {}
         self.start_time_utc = datetime.now(tz=timezone.utc)
 
+        # ECL may not be safe to use from several threads at once
+        self._ecl_lock = RLock()
+        # looks up start-of-run entries ahead of the end-of-run posts that need them
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ECLDAQRunLogger')
+
+        # posts are queued by log_run and sent together from _flush_posts
+        self._batcher = Batcher(self._flush_posts, max_size=batch_size, wait=batch_wait)
+
 
     @staticmethod
     def run_info_from_ecl_entry(entry):
         """
         Create a runinfo object from an ECL XML entry.
         Note the object returned here is used internally for run number
-        comparisons; we don't try to extract other all fields.
+        comparisons; we don't try to extract other all fields, and start_time
+        is left unset.
         """
         if entry.attrib['form'] not in [ECLDAQRunLogger.ECL_START_FORM, ECLDAQRunLogger.ECL_END_FORM]:
             raise ValueError(f'Entry did not correspond to form of type "{ECLDAQRunLogger.ECL_START_FORM}" or "{ECLDAQRunLogger.ECL_END_FORM}".')
 
-        now = datetime.now(tz=timezone.utc)
+        # entries we can't read are common enough (other posts in the category)
+        # to check for explicitly rather than raising and catching
+        body = entry.find('./text-html')
+        if body is None or not body.text:
+            return None
+
         try:
-            body = entry.find('./text-html')
-            table = ET.fromstring(body.text)
-            run_number = int(table.find('./tr/td/pre').text)
-        except Exception as e:
-            logger.exception(e)
+            table = ET.fromstring(body.text.encode('utf-8'), parser=_FRAGMENT_PARSER)
+        except ET.ParseError:
+            return None
+        if table is None:
+            return None
+
+        pre = table.find('./tr/td/pre')
+        text = pre.text.strip() if pre is not None and pre.text else ''
+        if not text.isdigit():
             return None
 
-        return RunInfo(run_number, start_time=now,
+        return RunInfo(int(text), start_time=None,
                 configuration='', metadata='', end_time=None)
 
+    def _search_recent_entries(self) -> str:
+        """Return the recent entries in our category, only hitting the ECL if
+        the last search is older than ECL_SEARCH_TTL seconds."""
+        searched_at, response = self._search_cache
+        now = time.monotonic()
+        if response is not None and now - searched_at < ECLDAQRunLogger.ECL_SEARCH_TTL:
+            return response
+
+        with self._ecl_lock:
+            response = self._ecl_service.search(category=ECLDAQRunLogger.ECL_CATEGORY, limit=20)
+        self._search_cache = (now, response)
+        return response
+
     def _get_start_post_for_run(self, run_number) -> Optional[RunInfo]:
         """Return the ECL entry number for a start-of-run post made by this class."""
+        with self._ecl_lock:
+            return self._find_start_post_for_run(run_number)
 
-        response = self._ecl_service.search(category=ECLDAQRunLogger.ECL_CATEGORY, limit=20)
-        xml = ET.fromstring(response)
-        entries = xml.findall('./entry')
-        entries = [e for e in entries if e.attrib['form'] == ECLDAQRunLogger.ECL_START_FORM]
+    def _find_start_post_for_run(self, run_number) -> Optional[RunInfo]:
+        entry_id = self._start_entry_ids.get(run_number)
+        if entry_id is not None:
+            return entry_id
 
-        if not entries:
-            return None
+        response = self._search_recent_entries()
+        # lxml refuses str input that carries an encoding declaration
+        xml = ET.fromstring(response.encode('utf-8'))
 
-        for e in entries:
+        # single pass over the start-of-run entries, stopping at the first
+        # match. Remember every entry we parse on the way for later lookups
+        for e in xml.iterfind(ECLDAQRunLogger.ECL_START_ENTRIES):
             info = ECLDAQRunLogger.run_info_from_ecl_entry(e)
             if info is None:
                 logger.warn(f'Could not parse entry {e}')
                 continue
 
+            self._remember_start_entry(info.run_number, e.attrib['id'])
             if info.run_number == run_number:
                 return e.attrib['id']
 
         return None
 
 
-    def _post_run(self, info: RunInfo, end_of_run: bool=False) -> None:
-        """Make the post to the ECL."""
-        logger.info(f'Writing run {info.run_number} to the ECL! {end_of_run=}')
-
-        form_name = ECLDAQRunLogger.ECL_START_FORM if not end_of_run \
-            else ECLDAQRunLogger.ECL_END_FORM
-
-        kwargs = {
-                'category': ECLDAQRunLogger.ECL_CATEGORY,
-                'formname': form_name
-        }
+    def _remember_start_entry(self, run_number: int, entry_id: str) -> None:
+        self._start_entry_ids[run_number] = entry_id
+        # keep this about as big as the run cache; dicts pop in insertion order
+        if len(self._start_entry_ids) > self._run_cache.maxlen:
+            del self._start_entry_ids[next(iter(self._start_entry_ids))]
 
-        start_ecl_entry_number = self._get_start_post_for_run(info.run_number)
-        if end_of_run and start_ecl_entry_number is not None:
-            kwargs['related_entry'] = start_ecl_entry_number
 
-        entry = ECLEntry(**kwargs)
+    def _post_run(self, info: RunInfo, end_of_run: bool=False, start_entry: Optional[Future]=None) -> None:
+        """Make the post to the ECL. For end-of-run posts, start_entry may hold
+        a lookup of the start-of-run entry that was started in advance."""
+        logger.info(f'Writing run {info.run_number} to the ECL! {end_of_run=}')
 
-        time_str = info.start_time.strftime('%Y-%m-%d %H:%M:%S')
+        # only end-of-run posts link back to the start-of-run entry
+        start_ecl_entry_number = None
         if end_of_run:
-            time_str = info.end_time.strftime('%Y-%m-%d %H:%M:%S')
-        
-        fields = {
-            'number': str(info.run_number),
-        }
+            if start_entry is not None:
+                start_ecl_entry_number = start_entry.result()
+            if start_ecl_entry_number is None:
+                # the start post may have gone out after the lookup began
+                start_ecl_entry_number = self._get_start_post_for_run(info.run_number)
+
+        # ECLEntry only builds a couple of XML elements; constructing one is
+        # cheaper than deep-copying a template, and a shallow copy would share
+        # the element tree between posts
+        entry = ECLEntry(category=ECLDAQRunLogger.ECL_CATEGORY,
+                formname=ECLDAQRunLogger.ECL_FORMS[end_of_run],
+                related_entry=start_ecl_entry_number)
+
+        # only format the time this post actually shows
         if not end_of_run:
-            fields['start_time'] = time_str
+            fields = _START_FIELDS_PROTOTYPE.copy()
+            fields['number'] = str(info.run_number)
+            fields['start_time'] = info.start_time.strftime(ECLDAQRunLogger.ECL_TIME_FORMAT)
             fields['configuration'] = info.configuration
             fields['included_components'] = '\n'.join(info.components)
             fields['metadata'] = info.metadata
         else:
-            fields['end_time'] = time_str
+            fields = _END_FIELDS_PROTOTYPE.copy()
+            fields['number'] = str(info.run_number)
             fields['crashed'] = 'Yes' if info.bad_end else 'No'
-            total_seconds = (info.end_time - info.start_time).total_seconds()
-            fields['duration'] = str(timedelta(seconds=total_seconds))
+            if info.end_time is None:
+                # the run ended without us seeing when; don't make it up
+                fields['end_time'] = 'unknown'
+                fields['duration'] = 'unknown'
+            else:
+                fields['end_time'] = info.end_time.strftime(ECLDAQRunLogger.ECL_TIME_FORMAT)
+                total_seconds = (info.end_time - info.start_time).total_seconds()
+                fields['duration'] = str(timedelta(seconds=total_seconds))
 
-        for key, value in fields.items():
-            entry.set_value(key, value)
+        entry.set_form_elements(fields)
 
         logger.info(entry.show().strip()[1:])
-        self._ecl_service.post(entry, do_post=True)
+        with self._ecl_lock:
+            self._ecl_service.post(entry, do_post=True)
+            # the cached search no longer includes our latest post
+            self._search_cache = (0.0, None)
+
+
+    def _queue_post(self, info: RunInfo, end_of_run: bool=False) -> None:
+        """Queue a post to be sent with the next batch. End-of-run posts start
+        looking up their start-of-run entry right away, so the search overlaps
+        the batch wait and rate limiting instead of delaying the post."""
+        start_entry = None
+        if end_of_run:
+            start_entry = self._executor.submit(self._get_start_post_for_run, info.run_number)
+        self._batcher.add((info, end_of_run, start_entry))
+
+
+    def _flush_posts(self, posts: List[Tuple[RunInfo, bool, Optional[Future]]]) -> None:
+        """Send a batch of queued posts, in order."""
+        ECLDAQRunLogger._rate_limiter.acquire()
+
+        for info, end_of_run, start_entry in posts:
+            try:
+                self._post_run(info, end_of_run=end_of_run, start_entry=start_entry)
+            except Exception as e:
+                logger.exception(e)
+
+
+    def flush(self) -> None:
+        """Send any queued posts now, e.g. before shutting down."""
+        self._batcher.flush()
 
 
     def filter_run(self, info: RunInfo) -> bool:
@@ -146,13 +294,6 @@ class ECLDAQRunLogger:
 
 
     def log_run(self, info: RunInfo) -> None:
-        # rate limit this function to 30 seconds between requests
-        now = datetime.now()
-        dt = (now - self._last_posted_time).total_seconds()
-        if dt < 30:
-            time.sleep(30 - dt)
-        self._last_posted_time = now
-        
         logger.info(f'logging run {info.run_number}')
 
         # some logic depending on the last run posted to the ECL
@@ -171,7 +312,7 @@ class ECLDAQRunLogger:
 
         if info.run_number < self._current_run.run_number:
             # this is definitely not the latest run, cache it
-            self._run_cache.append(info.run_number)
+            self._run_cache.add(info.run_number)
             return
 
         if info.run_number == self._current_run.run_number:
@@ -179,10 +320,10 @@ class ECLDAQRunLogger:
             # otherwise, do nothing
             if info.end_time is not None and self._current_run.end_time is None:
                 logger.info(f'posting end-of-run for run {info.run_number}')
-                self._post_run(info, end_of_run=True)
-                self._run_cache.append(info.run_number)
-                # this just does a copy; we aren't replacing anything
-                self._current_run = dataclasses.replace(info)
+                self._queue_post(info, end_of_run=True)
+                self._run_cache.add(info.run_number)
+                # RunInfo is frozen, so no copy is needed
+                self._current_run = info
             else:
                 logger.info(f'waiting on current run {self._current_run.run_number}')
             return
@@ -193,18 +334,20 @@ class ECLDAQRunLogger:
             # Make sure to add an end-of-post message for it, and cache it so
             # we don't process it again
             logger.warn(f'posting end-of-run for run {self._current_run.run_number}, but end time was not found!')
-            # this just does a copy; we aren't replacing anything
-            current_run_end = dataclasses.replace(self._current_run)
-            self._post_run(current_run_end, end_of_run=True)
-            self._run_cache.append(current_run_end.run_number)
+            # it never ended cleanly; end time and duration get posted as unknown
+            current_run_end = dataclasses.replace(self._current_run, bad_end=True)
+            self._queue_post(current_run_end, end_of_run=True)
+            self._run_cache.add(current_run_end.run_number)
             
         # this run is newer than our current run. Update our current run
         # also cache this so we don't re-process it
         logger.info(f'setting run {info.run_number} as the current run, newer than previous')
         self._current_run = info
         if info.end_time is not None:
-            # the run is already completed, so we won't post about it ever
-            self._run_cache.append(info.run_number)
+            # the run is already completed, so we won't post about it ever.
+            # note there is no start+end pair to coalesce here; a run we
+            # never saw running gets no ECL entries at all
+            self._run_cache.add(info.run_number)
             return
         
         # guard against posting a start-of-run entry the first time we start
@@ -215,4 +358,4 @@ class ECLDAQRunLogger:
 
         # post start-of-run! Note: don't add to cache until it ends
         logger.info(f'posting start-of-run for run {info.run_number}')
-        self._post_run(info)
+        self._queue_post(info)
@@ -1,32 +1,63 @@
 #!/usr/bin/env python3
 
+import re
 import sys 
 import time
-import string
-from collections import deque
 from typing import Optional, List
 from datetime import datetime, timezone
 
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.http import HttpError
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 
 from .daqrunlogger import RunInfo
+from .batcher import Batcher
+from .ratelimiter import TokenBucket
+from .runcache import RunCache
 
 import logging
 logger = logging.getLogger(__name__)
 
+# first row number of an A1 range such as 'Sheet1!A42:F42'
+_RANGE_ROW = re.compile(r'![A-Z]+(\d+)')
+
 
 class GoogleSheetsDAQRunLogger:
     """Adds run info to a Google sheet. Assumes column 'A' contains run numbers
     starting at row 1 plus fixed number of header rows."""
 
     INPUT_OPTS = 'USER_ENTERED'
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    # number of cells _row_values writes per run
+    NUM_COLS = 6
     SCOPES = [
         'https://www.googleapis.com/auth/spreadsheets',
     ]
-
-    def __init__(self, sheet_id: str, sheet_name: str, credentials_filename: str, header: int=0, range_phrase: Optional[str]=None):
+    # re-read the run column after this many seconds to pick up manual edits
+    ROW_MAP_TTL = 10 * 60
+    # in seconds, for each Sheets API request
+    HTTP_TIMEOUT = 30
+
+    # throttling and server errors worth retrying, and the first retry delay
+    # in seconds (doubled after each attempt, capped at RETRY_MAX_DELAY)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # the only error known to mean the request was not applied, so the only
+    # one safe to retry for a write that isn't idempotent
+    RETRY_STATUSES_NOT_APPLIED = (429,)
+    RETRY_DELAY = 1
+    RETRY_MAX_DELAY = 60
+
+    # partial responses: only ask for the parts of each write response we read
+    APPEND_FIELDS = 'updates/updatedRange,updates/updatedCells'
+    BATCH_UPDATE_FIELDS = 'totalUpdatedCells'
+
+    # shared by all instances, since they share the API quota: one batch per
+    # 10 seconds on average, allowing short bursts
+    _rate_limiter = TokenBucket(rate=1/10, burst=3)
+
+    def __init__(self, sheet_id: str, sheet_name: str, credentials_filename: str, header: int=0, range_phrase: Optional[str]=None, batch_size: int=10, batch_wait: float=2.0):
         self._spreadsheet_id = sheet_id
         self._sheet_name = sheet_name
         self._header = header
@@ -36,17 +67,74 @@ class GoogleSheetsDAQRunLogger:
 
         # range_phrase: append method will look for a table starting with this cell
         self._range_phrase = f'{self._sheet_name}!{range_phrase}'
-
-        self._api_wait_seconds = 10
-        self._last_post = datetime.fromtimestamp(0)
+        # the column name of the last column to update, e.g. column 1 is A, etc.
+        self._endcol = GoogleSheetsDAQRunLogger._col_letter(GoogleSheetsDAQRunLogger.NUM_COLS)
 
         credentials = service_account.Credentials.from_service_account_file(
             credentials_filename, scopes=GoogleSheetsDAQRunLogger.SCOPES)
-        self._service = build('sheets', 'v4', credentials=credentials)
+        # pin one keep-alive connection for the logger's lifetime so every
+        # get/update/append reuses the same TLS session
+        self._http = AuthorizedHttp(credentials,
+                http=httplib2.Http(timeout=GoogleSheetsDAQRunLogger.HTTP_TIMEOUT))
+        # use the discovery document bundled with the client library rather
+        # than fetching it over the network on every start
+        self._service = build('sheets', 'v4', http=self._http, cache_discovery=False,
+                static_discovery=True)
+
+        # maintain a list of known completed runs so we can skip duplicates.
+        # Written from the batch flush and read from filter_run
+        self._run_cache = RunCache(maxlen=1000)
+
+        # runs are queued by log_run and written together from _flush_runs
+        self._batcher = Batcher(self._flush_runs, max_size=batch_size, wait=batch_wait)
+
+        # run_row_map() result, kept up to date as we write. None until read
+        self._row_map = None
+        self._row_map_time = -float('inf')
+        # highest run number in the row map
+        self._max_seen = -1
+
+    @staticmethod
+    def _col_letter(n: int) -> str:
+        """A1 notation name of the n-th column (1-based): A..Z, AA, AB, ..."""
+        letters = ''
+        while n:
+            n, r = divmod(n - 1, 26)
+            letters = chr(ord('A') + r) + letters
+        return letters
+
+
+    def _execute_with_retry(self, request, attempts: int=5, idempotent: bool=True):
+        """Execute a Sheets API request, retrying timeouts, throttling and
+        server errors with exponential backoff. A Retry-After header from the
+        server takes precedence over the backoff delay.
+
+        A timeout or server error may come after the request was applied, so
+        for requests that aren't idempotent (appends) pass idempotent=False
+        to only retry throttling."""
+        retry_statuses = GoogleSheetsDAQRunLogger.RETRY_STATUSES
+        if not idempotent:
+            retry_statuses = GoogleSheetsDAQRunLogger.RETRY_STATUSES_NOT_APPLIED
+
+        delay = GoogleSheetsDAQRunLogger.RETRY_DELAY
+        for attempt in range(attempts):
+            try:
+                return request.execute()
+            except HttpError as e:
+                if e.resp.status not in retry_statuses or attempt == attempts - 1:
+                    raise
+                retry_after = e.resp.get('retry-after', '')
+                wait = float(retry_after) if retry_after.isdigit() else delay
+            except TimeoutError:
+                if not idempotent or attempt == attempts - 1:
+                    raise
+                wait = delay
+
+            wait = min(wait, GoogleSheetsDAQRunLogger.RETRY_MAX_DELAY)
+            logger.warn(f'Google sheets API request failed, retrying in {wait} s')
+            time.sleep(wait)
+            delay *= 2
 
-        # maintain a list of known completed runs so we can skip duplicates
-        # deque so that cache never gets too big
-        self._run_cache = deque(maxlen=1000)
 
     def run_row_map(self):
         """Gets valid run numbers from the first column of the spreadsheet. If
@@ -56,24 +144,49 @@ class GoogleSheetsDAQRunLogger:
         range_name = f'{self._sheet_name}!A{row_start}:A'
 
         try:
-            result = self._service.spreadsheets().values().get(
-                spreadsheetId=self._spreadsheet_id, range=range_name).execute()
+            # unformatted, so run numbers come back as ints rather than strings
+            result = self._execute_with_retry(self._service.spreadsheets().values().get(
+                spreadsheetId=self._spreadsheet_id, range=range_name,
+                valueRenderOption='UNFORMATTED_VALUE'))
         except (TimeoutError, HttpError):
             return None
 
         rows = result.get('values', [])
+        # apply header offset to get correct row. Later rows overwrite earlier
+        # ones, so a repeated run maps to its last row
         result = {}
+        invalid = []
+        for i, row in enumerate(rows, start=self._header + 1):
+            value = row[0] if row else None
+            if type(value) is int:
+                result[value] = i
+            elif isinstance(value, str) and value.isdigit():
+                # a run number entered as text
+                result[int(value)] = i
+            else:
+                invalid.append(i - 1)
 
-        for i, row in enumerate(rows):
-            try:
-                result[int(row[0])] = self._header + i + 1
-            except (ValueError, IndexError):
-                # apply header offset to get correct row
-                logger.warn(f'Warning: Invalid run number "{row}" at row={self._header + i}.')
+        if invalid:
+            logger.warn(f'Warning: {len(invalid)} invalid run numbers at rows {invalid}.')
 
         return result
 
 
+    def _get_row_map(self):
+        """Return the cached run_row_map(), reading the sheet the first time
+        and again once the cache is older than ROW_MAP_TTL."""
+        now = time.monotonic()
+        if self._row_map is None or now - self._row_map_time > GoogleSheetsDAQRunLogger.ROW_MAP_TTL:
+            runs = self.run_row_map()
+            if runs is None:
+                return None
+            self._row_map = runs
+            self._row_map_time = now
+            self._max_seen = max(runs) if runs else -1
+
+        return self._row_map
+
+
     def filter_run(self, info: RunInfo) -> bool:
         """Only post shifter runs to the sheet."""
         if info.dev_run:
@@ -87,28 +200,27 @@ class GoogleSheetsDAQRunLogger:
         return True
 
     def log_run(self, info: RunInfo) -> None:
+        """Queue the run; it is written to the sheet with the next batch."""
+        logger.info(f'queueing run {info.run_number}')
+        self._batcher.add(info)
 
-        # rate limit to 1 seconds between requests
-        now = datetime.now()
-        dt = (now - self._last_post).total_seconds()
-        if dt < self._api_wait_seconds:
-            time.sleep(self._api_wait_seconds - dt)
-        logger.info(f'handling run {info.run_number}')
 
-        start_time = info.start_time.strftime('%Y-%m-%d %H:%M:%S')
+    def flush(self) -> None:
+        """Write any queued runs now, e.g. before shutting down."""
+        self._batcher.flush()
+
+
+    def _row_values(self, info: RunInfo) -> list:
+        """The cells we write for a run."""
+        start_time = info.start_time.strftime(GoogleSheetsDAQRunLogger.TIME_FORMAT)
 
-        runs = self.run_row_map()
-        if runs is None:
-            logger.warn('Error when accessing Google sheets API, retrying...')
-            return
-	
         # End time: If properly set, run has concluded. If not, check if there
-	# are runs after this run. If so, maybe run was ended un-gracefully
+        # are runs after this run. If so, maybe run was ended un-gracefully
         end_time = ''
         if info.end_time is not None:
-            end_time = info.end_time.strftime('%Y-%m-%d %H:%M:%S')
+            end_time = info.end_time.strftime(GoogleSheetsDAQRunLogger.TIME_FORMAT)
         else:
-            if any(run > info.run_number for run in runs.keys()):
+            if self._max_seen > info.run_number:
                 end_time = 'unknown'
             else:
                 runtime = int((datetime.now(timezone.utc) - info.start_time).total_seconds())
@@ -119,52 +231,105 @@ class GoogleSheetsDAQRunLogger:
 
         # note: don't write comments since it may overwrite what the shifter
         # has written
-        body = {
-            'values': [
-                [
-                    info.run_number, start_time, end_time, info.configuration,\
-                    ', '.join(info.components), 'Yes' if info.bad_end else 'No'
-                ]
-            ]
-        }
+        return [
+            info.run_number, start_time, end_time, info.configuration,\
+            ', '.join(info.components), 'Yes' if info.bad_end else 'No'
+        ]
 
-        row = None
-        try:
+
+    def _flush_runs(self, infos: List[RunInfo]) -> None:
+        """Write a batch of runs: one batchUpdate for runs already in the
+        sheet, and one append for the new ones."""
+        GoogleSheetsDAQRunLogger._rate_limiter.acquire()
+        logger.info(f'handling runs {[info.run_number for info in infos]}')
+
+        runs = self._get_row_map()
+        if runs is None:
+            logger.warn('Error when accessing Google sheets API, retrying...')
+            return
+
+        # only the latest info for each run matters
+        latest = {}
+        for info in infos:
+            latest[info.run_number] = info
+
+        updates = []
+        new_runs = []
+        for info in latest.values():
+            if info.run_number in runs:
+                updates.append(info)
+            else:
+                logger.debug(f'Found new run {info.run_number}, appending')
+                new_runs.append(info)
+
+        if updates:
+            self._update_rows(updates, runs)
+        if new_runs:
+            self._append_rows(new_runs, runs)
+
+
+    def _update_rows(self, infos: List[RunInfo], runs) -> None:
+        data = []
+        for info in infos:
             row = runs[info.run_number] - 1
             logger.debug(f'Found row={row}')
-        except KeyError:
-            logger.debug(f'Found new run, appending')
-            pass
+            data.append({'range': f'A{row}:{self._endcol}{row}', 'values': [self._row_values(info)]})
 
-        # get the column name of the last column to update, e.g. column 0 is A, etc.
-        endcol = string.ascii_uppercase[len(body['values'][0]) - 1]
+        body = {
+            'valueInputOption': GoogleSheetsDAQRunLogger.INPUT_OPTS,
+            'data': data,
+        }
         try:
-            if row is not None:
-                result = self._service.spreadsheets().values().update(
-                    spreadsheetId=self._spreadsheet_id, range=f'A{row}:{endcol}{row}',
-                    valueInputOption=GoogleSheetsDAQRunLogger.INPUT_OPTS, body=body).execute()
-            else:
-                result = self._service.spreadsheets().values().append(
-                    spreadsheetId=self._spreadsheet_id, range=self._range_phrase,
-                    valueInputOption=GoogleSheetsDAQRunLogger.INPUT_OPTS, body=body).execute()
+            result = self._execute_with_retry(self._service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self._spreadsheet_id, body=body,
+                fields=GoogleSheetsDAQRunLogger.BATCH_UPDATE_FIELDS))
         except (TimeoutError, HttpError):
             logger.warn('Error when accessing Google sheets API, retrying...')
+            # the sheet may have changed under us, re-read it next time
+            self._row_map = None
             return
 
-        updated_cells = 0
+        if result.get('totalUpdatedCells', 0) == 0:
+            logger.warn(f'Warning: Unexpected result {result}')
+
+        self._cache_completed(infos)
+
 
-        # update and append results have different structure
+    def _append_rows(self, infos: List[RunInfo], runs) -> None:
+        body = {
+            'values': [self._row_values(info) for info in infos]
+        }
         try:
-            updated_cells = result['updates']['updatedCells']
-        except KeyError:
-            try:
-                updated_cells = result['updatedCells']
-            except KeyError:
-                pass
+            result = self._execute_with_retry(self._service.spreadsheets().values().append(
+                spreadsheetId=self._spreadsheet_id, range=self._range_phrase,
+                valueInputOption=GoogleSheetsDAQRunLogger.INPUT_OPTS, body=body,
+                fields=GoogleSheetsDAQRunLogger.APPEND_FIELDS), idempotent=False)
+        except (TimeoutError, HttpError):
+            logger.warn('Error when accessing Google sheets API, retrying...')
+            # the rows may have been appended anyway. Re-read the sheet so the
+            # next flush updates them rather than appending them again
+            self._row_map = None
+            return
 
-        if updated_cells == 0:
+        updates = result.get('updates', {})
+        if updates.get('updatedCells', 0) == 0:
             logger.warn(f'Warning: Unexpected result {result}')
 
-        if info.end_time is not None:
-            self._run_cache.append(info.run_number) 
-        self._last_post = now
+        # remember where the new runs landed, one row each starting at the top
+        # of the updated range. Like run_row_map, store one past the actual row
+        match = _RANGE_ROW.search(updates.get('updatedRange', ''))
+        if match is not None:
+            first_row = int(match.group(1))
+            for i, info in enumerate(infos):
+                runs[info.run_number] = first_row + i + 1
+                self._max_seen = max(self._max_seen, info.run_number)
+        else:
+            self._row_map = None
+
+        self._cache_completed(infos)
+
+
+    def _cache_completed(self, infos: List[RunInfo]) -> None:
+        for info in infos:
+            if info.end_time is not None:
+                self._run_cache.add(info.run_number)
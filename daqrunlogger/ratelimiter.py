@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. Up to burst calls to acquire()
+    go through immediately, after which callers sleep just long enough to
+    hold the average at rate calls per second. Share one instance between
+    loggers to make them share a quota."""
+    def __init__(self, rate: float, burst: int=1):
+        # tokens per second
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """Take a token, sleeping until one is available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+
+            # going negative reserves a future token, so concurrent callers
+            # queue up behind each other without holding the lock while asleep
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+from collections import deque
+from threading import Lock
+
+
+class RunCache:
+    """Bounded set of run numbers a logger is done with. Once maxlen runs are
+    held, adding one evicts the oldest. Membership checks are O(1) and safe
+    to make from any thread while another adds."""
+    def __init__(self, maxlen: int=1000):
+        # deque keeps the eviction order, set answers membership queries
+        self._order = deque(maxlen=maxlen)
+        self._runs = set()
+        # guards adds, so the deque and set evict the same run
+        self._lock = Lock()
+
+    @property
+    def maxlen(self) -> int:
+        return self._order.maxlen
+
+    def __contains__(self, run_number: int) -> bool:
+        return run_number in self._runs
+
+    def add(self, run_number: int) -> None:
+        """Remember a run, evicting the oldest if full."""
+        with self._lock:
+            if run_number in self._runs:
+                return
+
+            if len(self._order) == self._order.maxlen:
+                self._runs.discard(self._order[0])
+            self._order.append(run_number)
+            self._runs.add(run_number)
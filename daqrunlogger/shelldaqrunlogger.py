@@ -1,26 +1,170 @@
 #!/usr/bin/env python3
 
+import os
+import json
+import dataclasses
+import re
+import time
+import mmap
+import functools
+import shutil
+import selectors
 import subprocess
+from queue import Queue, Full, Empty
+from threading import Thread, Condition
 from datetime import datetime, timezone
-from typing import Optional, List
-from collections import deque
+from typing import Optional, List, Callable, Union, get_args, get_origin
 
 from .daqrunlogger import RunInfo
 
+import logging
+logger = logging.getLogger(__name__)
+
+# subprocess calls pass close_fds=False to skip closing every open fd before
+# exec. That only leaks fds marked inheritable, and python opens files,
+# sockets and pipes non-inheritable by default (PEP 446), as do the HTTP
+# clients and this module. subprocess already uses vfork/posix_spawn where
+# it can, and unlike a bare posix_spawn it restores SIGPIPE and SIGXFSZ,
+# which python ignores, in the child
+
+
+@functools.lru_cache(maxsize=512)
+def _fmt_dt(dt: datetime, fmt: str) -> str:
+    # the same ongoing run's start time gets formatted on every poll
+    return dt.strftime(fmt)
+
+
+# strftime directives that are plain zero-padded numbers, as f-string fields
+_NUMERIC_DIRECTIVES = {
+    'Y': '{dt.year:04d}',
+    'm': '{dt.month:02d}',
+    'd': '{dt.day:02d}',
+    'H': '{dt.hour:02d}',
+    'M': '{dt.minute:02d}',
+    'S': '{dt.second:02d}',
+    'f': '{dt.microsecond:06d}',
+}
+_DIRECTIVE = re.compile(r'%(.)')
+
+
+def _compile_date_format(fmt: str) -> Optional[Callable[[datetime], str]]:
+    """Compile a strftime format made only of numeric directives and literal
+    text into an equivalent f-string function, which skips strftime's C
+    overhead. Returns None for any other format."""
+    template = []
+    pos = 0
+    for match in _DIRECTIVE.finditer(fmt):
+        literal = fmt[pos:match.start()]
+        template.append(literal.replace('{', '{{').replace('}', '}}'))
+        directive = match.group(1)
+        if directive == '%':
+            template.append('%')
+        elif directive in _NUMERIC_DIRECTIVES:
+            template.append(_NUMERIC_DIRECTIVES[directive])
+        else:
+            return None
+        pos = match.end()
+    if '%' in fmt[pos:]:
+        # a dangling '%' at the end
+        return None
+    template.append(fmt[pos:].replace('{', '{{').replace('}', '}}'))
+
+    # repr() handles quotes and backslashes in the literal text
+    namespace = {}
+    exec(f'def _format(dt): return f{"".join(template)!r}', namespace)
+    return namespace['_format']
+
 
 class ShellDAQRunLogger:
     """Runs a shell command based on the run info. Optionally construct this
     logger with a list of attributes which are passed as arguments to the shell
-    command."""
+    command.
+
+    shell_cmd may also be a python callable, which is called in-process as
+    shell_cmd(info, *args) with the same arguments the command would get. It
+    returns an exit code (None counts as 0); an exception counts as exit
+    code 1.
+
+    With background=True, log_run only queues the command and returns; a
+    worker thread runs queued commands one after another. If more than
+    MAX_QUEUED commands are waiting, the oldest is dropped.
 
-    def __init__(self, shell_cmd: str, forward_attrs: Optional[List[str]]=None, date_format: str='%Y-%m-%d %H:%M:%S'):
+    With async_submit=True (Linux only), commands are started without waiting
+    for them to exit. A reaper thread collects their exit codes. Call flush()
+    to wait for everything started so far. This can't be combined with
+    batch_mode, persistent or a callable shell_cmd.
+
+    With batch_mode='stdin', the command gets no arguments. Instead it reads
+    runs from stdin, one line per run. Each line is a JSON array with one
+    element per forwarded attribute, in forward_attrs order:
+      - datetimes are strings formatted with date_format (not split)
+      - components is an array of strings
+      - ints and bools are JSON numbers and booleans, other fields strings
+      - a field that isn't set is null
+    JSON escapes tabs and newlines in the free-text fields, so one line is
+    always one run. batch_log_runs() then sends several runs to a single
+    invocation.
+
+    With persistent=True, the command is started once and kept running, and
+    every run is written to its stdin in the same format, one JSON array per
+    line, so the command must loop over its input (e.g. `while read -r line;
+    do ...; done`, parsing each line as JSON). The
+    exit code then only tells whether the record was delivered. Call close()
+    to end the command."""
+
+    MAX_QUEUED = 128
+    BATCH_MODES = (None, 'stdin')
+    # DAQLoggerPool may hand us a filtered backlog through batch_log_runs
+    SUPPORTS_BATCH = True
+    # exit codes kept by pid for async_submit, oldest dropped first
+    MAX_RETURN_CODES = 1000
+
+    def __init__(self, shell_cmd: Union[str, Callable[..., Optional[int]]], forward_attrs: Optional[List[str]]=None, date_format: str='%Y-%m-%d %H:%M:%S', background: bool=False, async_submit: bool=False, batch_mode: Optional[str]=None, persistent: bool=False):
+        if batch_mode not in ShellDAQRunLogger.BATCH_MODES:
+            raise ValueError(f'unknown batch_mode {batch_mode!r}, expected one of {ShellDAQRunLogger.BATCH_MODES}')
+        if async_submit:
+            # these never start a child per run for the reaper to wait on
+            if batch_mode is not None or persistent or callable(shell_cmd):
+                raise ValueError('async_submit can\'t be combined with batch_mode, persistent or a callable shell_cmd')
+            if not hasattr(os, 'pidfd_open'):
+                raise ValueError('async_submit needs os.pidfd_open (Linux, python >= 3.9)')
+        self._batch_mode = batch_mode
+        if persistent:
+            # a persistent command reads the same records from stdin
+            self._batch_mode = 'stdin'
+        self._persistent = persistent
+        self._child = None
         self._shell_cmd = shell_cmd
+        self._is_callable = callable(shell_cmd)
+        if not self._is_callable:
+            # look the command up on PATH once rather than on every spawn
+            self._resolved_cmd = shutil.which(shell_cmd) or shell_cmd
         self._forward_attrs = []
         if forward_attrs is not None:
             self._forward_attrs = forward_attrs
         self._date_format = date_format
+        self._dt_formatter = _compile_date_format(date_format)
+        if self._dt_formatter is None:
+            self._dt_formatter = lambda dt: _fmt_dt(dt, date_format)
         self._last_return_code = None
 
+        self._build_args = self._compile_build_args()
+
+        self._queue = None
+        if background:
+            self._queue = Queue(maxsize=ShellDAQRunLogger.MAX_QUEUED)
+            self._worker = Thread(target=self._run_queued, name='ShellDAQRunLogger')
+            # this thread will exit once the main thread does
+            self._worker.daemon = True
+            self._worker.start()
+
+        self._async_submit = async_submit
+        if async_submit:
+            self._start_reaper()
+
+        if persistent and not self._is_callable:
+            self._start_child()
+
 
     def filter_run(self, info: RunInfo) -> bool:
         """Accept any run."""
@@ -28,61 +172,350 @@ class ShellDAQRunLogger:
 
 
     def log_run(self, info: RunInfo) -> None:
-        args = [self._shell_cmd]
-        for attr_name in self._forward_attrs:
-            attr = getattr(info, attr_name)
-            if isinstance(attr, (list, tuple)):
-                args += [str(val) for val in attr]
-            elif isinstance(attr, datetime):
-                args += [d for d in attr.strftime(self._date_format).split()]
-            elif attr is None:
-                args += ['']
-            else:
-                args += [str(attr)]
-
-        result = subprocess.run(args)
+        args = self._build_args(info)
+        if self._queue is None:
+            self._run(info, args)
+            return
+
+        while True:
+            try:
+                self._queue.put_nowait((info, args))
+                return
+            except Full:
+                pass
+
+            # make room by dropping the oldest command
+            try:
+                _, dropped = self._queue.get_nowait()
+                self._queue.task_done()
+                logger.warning(f'shell queue full, dropped {dropped}')
+            except Empty:
+                pass
+
+
+    def batch_log_runs(self, infos: List[RunInfo]) -> None:
+        """Log several runs. With batch_mode='stdin' they all go to one run of
+        the command, otherwise this is the same as log_run on each."""
+        if self._batch_mode != 'stdin' or self._is_callable:
+            for info in infos:
+                self.log_run(info)
+            return
+
+        if self._queue is not None:
+            # keep the batch behind commands already queued
+            self._queue.join()
+        self._run_stdin(infos)
+
+
+    def _compile_build_args(self) -> Callable[[RunInfo], List[str]]:
+        """Generate the function that builds the command line for a run.
+        Each forwarded attribute is formatted according to its RunInfo
+        annotation, so nothing is type-checked per call."""
+        namespace = {'_cmd': self._shell_cmd, '_dt': self._dt_formatter}
+
+        # when every whitespace-separated piece of the date format compiles
+        # to an f-string, format the pieces separately: each one is exactly
+        # one argument, and nothing needs splitting afterwards
+        dt_body = '_dt({0}).split()'
+        part_formatters = [_compile_date_format(part) for part in self._date_format.split()]
+        if None not in part_formatters:
+            for i, part_formatter in enumerate(part_formatters):
+                namespace[f'_dt{i}'] = part_formatter
+            dt_body = '(' + ''.join(f'_dt{i}({{0}}), ' for i in range(len(part_formatters))) + ')'
+
+        # plain attribute access on the dataclass fields; python already
+        # specializes that, so there is nothing to gain from slot descriptors
+        field_types = {field.name: field.type for field in dataclasses.fields(RunInfo)}
+        items = []
+        for i, attr_name in enumerate(self._forward_attrs):
+            if attr_name not in field_types:
+                raise ValueError(f'{attr_name!r} is not a RunInfo field, expected one of {list(field_types)}')
+            hint = field_types[attr_name]
+            items.append(self._arg_source(f'info.{attr_name}', f'_v{i}', hint, dt_body))
+
+        source = f'def _build_args(info):\n    return [_cmd, {", ".join(items)}]\n'
+        exec(source, namespace)
+        return namespace['_build_args']
+
+
+    @staticmethod
+    def _arg_source(expr: str, var: str, hint, dt_body: str) -> str:
+        """Source for the list item(s) holding the arguments for expr, an
+        attribute of info annotated with hint. var is a free local name, and
+        dt_body the source formatting a datetime {0}."""
+        hint_args = get_args(hint)
+        optional = get_origin(hint) is Union and type(None) in hint_args
+        if optional:
+            hint = next(arg for arg in hint_args if arg is not type(None))
+
+        # body formats a value already known not to be None; splat if it
+        # gives several arguments
+        if hint is datetime:
+            splat, body = True, dt_body
+        elif get_origin(hint) in (list, tuple):
+            splat, body = True, 'map(str, {0})'
+        else:
+            splat, body = False, 'str({0})'
+
+        if not optional:
+            return ('*' if splat else '') + body.format(expr)
+        if splat:
+            return f"*(('',) if ({var} := {expr}) is None else {body.format(var)})"
+        return f"'' if ({var} := {expr}) is None else {body.format(var)}"
+
+
+    def _run(self, info: RunInfo, args: List[str]) -> None:
+        if self._is_callable:
+            self._last_return_code = self._call(info, args)
+            return
+
+        if self._batch_mode == 'stdin':
+            self._run_stdin([info])
+            return
+
+        args = [self._resolved_cmd, *args[1:]]
+        if self._async_submit:
+            self._track_child(subprocess.Popen(args, close_fds=False))
+            return
+
+        result = subprocess.run(args, close_fds=False)
         self._last_return_code = result.returncode
 
 
+    def _stdin_record(self, info: RunInfo) -> str:
+        values = [getattr(info, attr_name) for attr_name in self._forward_attrs]
+        # datetimes are the only RunInfo values json can't encode itself
+        return json.dumps(values, default=self._dt_formatter) + '\n'
+
+
+    def _run_stdin(self, infos: List[RunInfo]) -> None:
+        lines = ''.join(self._stdin_record(info) for info in infos)
+        if self._persistent:
+            self._write_child(lines)
+            return
+
+        proc = subprocess.Popen([self._shell_cmd], stdin=subprocess.PIPE, text=True, close_fds=False)
+        proc.communicate(lines)
+        self._last_return_code = proc.returncode
+
+
+    def _start_child(self) -> None:
+        self._child = subprocess.Popen([self._shell_cmd], stdin=subprocess.PIPE, text=True, close_fds=False)
+
+
+    def _write_child(self, lines: str) -> None:
+        if self._child is None or self._child.poll() is not None:
+            if self._child is not None:
+                logger.warning(f'shell command exited with {self._child.returncode}, restarting it')
+            self._start_child()
+
+        # every record is exactly one line of JSON, so no value can push the
+        # long-lived reader out of step with the records that follow
+        try:
+            self._child.stdin.write(lines)
+            self._child.stdin.flush()
+        except BrokenPipeError:
+            # the command went away mid-write; the next run restarts it
+            self._last_return_code = self._child.wait()
+            logger.warning(f'shell command exited with {self._last_return_code}, lost runs {lines!r}')
+            return
+        self._last_return_code = 0
+
+
+    def close(self) -> None:
+        """Finish any queued commands, then end a persistent command and
+        wait for it to exit."""
+        self.flush()
+        if self._child is None:
+            return
+
+        try:
+            self._child.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._last_return_code = self._child.wait()
+        self._child = None
+
+
+    def _call(self, info: RunInfo, args: List[str]) -> int:
+        try:
+            code = self._shell_cmd(info, *args[1:])
+        except Exception as e:
+            logger.exception(e)
+            return 1
+        return 0 if code is None else int(code)
+
+
+    def flush(self) -> None:
+        """Wait until every command logged so far has finished."""
+        if self._queue is not None:
+            self._queue.join()
+        if self._async_submit:
+            with self._reap_cond:
+                self._reap_cond.wait_for(lambda: self._running == 0)
+
+
+    def _start_reaper(self) -> None:
+        # exit codes by pid, for async_submit
+        self._returncodes = {}
+        # children spawned but not yet reaped
+        self._running = 0
+        # (pidfd, Popen) pairs waiting for the reaper to pick up
+        self._new_children = []
+        # guards the three above
+        self._reap_cond = Condition()
+
+        # only the reaper thread touches the selector; log_run hands it new
+        # children through _new_children and wakes it with the pipe
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+
+        self._reaper = Thread(target=self._reap_loop, name='ShellDAQRunLogger-reaper')
+        # this thread will exit once the main thread does
+        self._reaper.daemon = True
+        self._reaper.start()
+
+
+    def _track_child(self, proc: subprocess.Popen) -> None:
+        # a pidfd becomes readable when the child exits. Opening it before
+        # the child is reaped is fine even if it has already exited
+        pidfd = os.pidfd_open(proc.pid)
+        with self._reap_cond:
+            self._new_children.append((pidfd, proc))
+            self._running += 1
+        os.write(self._wake_w, b'\0')
+
+
+    def _reap_loop(self) -> None:
+        while True:
+            for key, _ in self._selector.select():
+                if key.fd == self._wake_r:
+                    os.read(self._wake_r, 512)
+                    with self._reap_cond:
+                        new_children, self._new_children = self._new_children, []
+                    for pidfd, proc in new_children:
+                        self._selector.register(pidfd, selectors.EVENT_READ, proc)
+                    continue
+
+                self._selector.unregister(key.fd)
+                os.close(key.fd)
+                # reap through Popen, so it never waits on the pid itself
+                proc = key.data
+                code = proc.wait()
+
+                with self._reap_cond:
+                    self._last_return_code = code
+                    self._returncodes[proc.pid] = code
+                    if len(self._returncodes) > ShellDAQRunLogger.MAX_RETURN_CODES:
+                        del self._returncodes[next(iter(self._returncodes))]
+                    self._running -= 1
+                    self._reap_cond.notify_all()
+
+
+    def _run_queued(self) -> None:
+        while True:
+            info, args = self._queue.get()
+            try:
+                self._run(info, args)
+            except Exception as e:
+                logger.exception(e)
+            self._queue.task_done()
+
+
 class OnStartDAQRunLogger(ShellDAQRunLogger):
     """Only accept runs with start times within the last N seconds, then hang
-    on to the run until it's processed."""
+    on to the run until it's processed.
+
+    With cache_path set, the processed runs are kept in that file (memory
+    mapped) so they survive a restart and the shell command is not re-run
+    for them."""
 
-    def __init__(self, shell_cmd: str, forward_attrs: Optional[List[str]]=None, date_format: str='%Y-%m-%d %H:%M:%S', max_delay: int=60*60*24):
+    # number of processed runs remembered
+    CACHE_SIZE = 1000
+    # in seconds, how long filter_run reuses its reading of the clock. Tiny
+    # next to max_delay
+    NOW_TTL = 0.5
+
+    # filter_run depends on the outcome of each log_run, so a backlog can't
+    # be filtered ahead of logging it as one batch
+    SUPPORTS_BATCH = False
+
+    def __init__(self, shell_cmd: Union[str, Callable[..., Optional[int]]], forward_attrs: Optional[List[str]]=None, date_format: str='%Y-%m-%d %H:%M:%S', max_delay: int=60*60*24, cache_path: Optional[str]=None):
         super().__init__(shell_cmd, forward_attrs, date_format)
         self.max_delay = max_delay
         self.current_run = None
-        self.cache = deque(maxlen=1000)
+        # (monotonic time, utc now) from the last clock reading
+        self._now_cache = None
+        # processed runs: the set answers membership, the ring buffer only
+        # keeps the order to evict them in
+        self._cache_set = set()
+        self._ring_idx = 0
+        # whether the ring has filled up, so the next slot holds a run to evict
+        self._ring_wrapped = False
+        self._ring_header = None
+        if cache_path is None:
+            self._ring = [None] * OnStartDAQRunLogger.CACHE_SIZE
+        else:
+            self._open_cache(cache_path)
+
+    def _open_cache(self, cache_path: str) -> None:
+        # file layout, native int32s: write index, wrapped flag, then the ring.
+        # No fsync; the kernel writes the pages back on its own
+        size = 4 * (2 + OnStartDAQRunLogger.CACHE_SIZE)
+        fd = os.open(cache_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            # the mapping keeps its own reference to the file
+            os.close(fd)
+
+        view = memoryview(self._mmap).cast('i')
+        self._ring_header = view[:2]
+        self._ring = view[2:]
+
+        idx, wrapped = self._ring_header
+        if not 0 <= idx < OnStartDAQRunLogger.CACHE_SIZE:
+            logger.warning(f'ignoring corrupt run cache {cache_path}')
+            idx, wrapped = 0, 0
+        self._ring_idx = idx
+        self._ring_wrapped = bool(wrapped)
+        self._cache_set = set(self._ring if self._ring_wrapped else self._ring[:idx])
 
     def filter_run(self, info: RunInfo) -> bool:
-        # we've already processed this run
-        if info.dev_run:
-            # print(f'skip run {info.run_number}, started from dev area')
+        # we've already processed this run. Most polls only see known runs,
+        # so check this first
+        run_number = info.run_number
+        if run_number in self._cache_set:
+            # print(f'Skipping known run {run_number}')
             return False
 
-        if info.run_number in self.cache:
-            # print(f'Skipping known run {info.run_number}')
+        if info.dev_run:
+            # print(f'skip run {run_number}, started from dev area')
             return False
 
         # a completed run. If it's our current one but we haven't processed it
-        # yet, process it but also cache it so we don't re-run it
+        # yet, process it. With no current run it won't get past the check
+        # below again, so it isn't re-run even if the command fails
         if info.end_time is not None:
             if self.current_run is not None:
-                if info.run_number == self.current_run.run_number and not info.run_number in self.cache:
-                    self.cache.append(info.run_number)
+                if run_number == self.current_run.run_number:
                     self.current_run = None
                     return True
 
-            # print(f'Skipping completed run {info.run_number}')
+            # print(f'Skipping completed run {run_number}')
             return False
 
         # ongoing run & its the current one, let's process it
         if self.current_run is not None:
-            if info.run_number < self.current_run.run_number:
+            current_run_number = self.current_run.run_number
+            if run_number < current_run_number:
                 # an old run missing an end time
                 return False
 
-            if info.run_number > self.current_run.run_number:
+            if run_number > current_run_number:
                 # Must be a new run & we missed the end time of our current one. Reset
                 # for the new one
                 self.current_run = info
@@ -91,10 +524,10 @@ class OnStartDAQRunLogger(ShellDAQRunLogger):
 
         # we don't have a run so this could be the current one
         # let's do a sanity check that it isn't >1 day old
-        now = datetime.now(timezone.utc)
+        now = self._now()
         dt = (now - info.start_time).total_seconds()
         if dt > self.max_delay:
-            # print(f'Skipping incomplete run {info.run_number}, started more than {self.max_delay} seconds ago.')
+            # print(f'Skipping incomplete run {run_number}, started more than {self.max_delay} seconds ago.')
             return False
         
         # ok, seems plausible
@@ -102,12 +535,51 @@ class OnStartDAQRunLogger(ShellDAQRunLogger):
         return True
 
     def log_run(self, info: RunInfo) -> None:
+        if info.run_number in self._cache_set:
+            # already processed, e.g. a repeat that passed filter_run before
+            # the first one finished
+            return
+
         super().log_run(info)
         if self._last_return_code == 0:
             print(f'Shell logger completed ongoing run {info.run_number}')
-            self.cache.append(info.run_number)
+            self._cache_run(info.run_number)
             self.current_run = None
 
+    def _now(self) -> datetime:
+        """The current UTC time, read once per NOW_TTL: a poll checks many
+        runs against the same clock."""
+        t = time.monotonic()
+        cached = self._now_cache
+        if cached is not None and t - cached[0] < OnStartDAQRunLogger.NOW_TTL:
+            return cached[1]
+
+        now = datetime.now(timezone.utc)
+        self._now_cache = (t, now)
+        return now
+
+    def _cache_run(self, run_number: int) -> None:
+        """Remember a run we are done with, evicting the oldest if full."""
+        if run_number in self._cache_set:
+            return
+
+        idx = self._ring_idx
+        if self._ring_wrapped:
+            # the slot we overwrite holds the oldest run
+            self._cache_set.discard(self._ring[idx])
+        self._ring[idx] = run_number
+        self._cache_set.add(run_number)
+
+        idx += 1
+        if idx == OnStartDAQRunLogger.CACHE_SIZE:
+            idx = 0
+            self._ring_wrapped = True
+        self._ring_idx = idx
+        if self._ring_header is not None:
+            # after the slot itself, so a crash here at worst forgets one run
+            self._ring_header[0] = idx
+            self._ring_header[1] = self._ring_wrapped
+
 
 if __name__ == '__main__':
     s = ShellDAQRunLogger('echo', ['run_number'])
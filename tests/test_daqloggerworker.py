@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import time
+import unittest
+from datetime import datetime
+from threading import Lock
+
+from daqrunlogger import DAQLoggerPool, RunInfo
+
+
+class RecordingLogger:
+    """Accepts runs whose number isn't a multiple of skip_every, and records
+    them. Fails if it is ever asked to handle two runs at once."""
+    def __init__(self, delay: float=0.0, skip_every: int=0):
+        self.delay = delay
+        self.skip_every = skip_every
+        self.seen = []
+        self.flushed = False
+        self.overlapped = False
+        self._lock = Lock()
+
+    def filter_run(self, info: RunInfo) -> bool:
+        return not (self.skip_every and info.run_number % self.skip_every == 0)
+
+    def log_run(self, info: RunInfo) -> None:
+        if not self._lock.acquire(blocking=False):
+            self.overlapped = True
+            return
+        try:
+            time.sleep(self.delay)
+            self.seen.append(info.run_number)
+        finally:
+            self._lock.release()
+
+    def flush(self) -> None:
+        self.flushed = True
+
+
+class BatchingLogger(RecordingLogger):
+    SUPPORTS_BATCH = True
+
+    def __init__(self, delay: float=0.0):
+        super().__init__(delay=delay)
+        self.batches = []
+
+    def batch_log_runs(self, infos) -> None:
+        self.batches.append([info.run_number for info in infos])
+        for info in infos:
+            self.log_run(info)
+
+
+class OptedOutLogger(BatchingLogger):
+    SUPPORTS_BATCH = False
+
+
+def make_run(run_number: int) -> RunInfo:
+    return RunInfo(run_number, datetime.now(), 'config', 'metadata')
+
+
+class DAQLoggerPoolTest(unittest.TestCase):
+    def test_each_logger_sees_accepted_runs_in_order(self):
+        loggers = [RecordingLogger(), RecordingLogger(delay=0.002, skip_every=3)]
+        pool = DAQLoggerPool(loggers)
+        for run_number in range(50):
+            pool.submit(make_run(run_number))
+        pool.join()
+
+        self.assertEqual(loggers[0].seen, list(range(50)))
+        self.assertEqual(loggers[1].seen, [n for n in range(50) if n % 3])
+        self.assertFalse(any(l.overlapped for l in loggers))
+        pool.shutdown()
+
+    def test_join_trims_the_run_log(self):
+        pool = DAQLoggerPool([RecordingLogger(), RecordingLogger(delay=0.002)])
+        for run_number in range(20):
+            pool.submit(make_run(run_number))
+        pool.join()
+
+        self.assertEqual(len(pool._runs), 0)
+        self.assertEqual(pool._first_seq, 20)
+        self.assertEqual(pool._cursors, [20, 20])
+        pool.shutdown()
+
+    def test_shutdown_flushes_loggers(self):
+        run_logger = RecordingLogger(delay=0.002)
+        pool = DAQLoggerPool([run_logger])
+        for run_number in range(10):
+            pool.submit(make_run(run_number))
+        pool.shutdown()
+
+        self.assertEqual(run_logger.seen, list(range(10)))
+        self.assertTrue(run_logger.flushed)
+        self.assertFalse(pool._scheduler.is_alive())
+
+    def test_shutdown_without_wait_keeps_queued_runs(self):
+        run_logger = RecordingLogger(delay=0.002)
+        pool = DAQLoggerPool([run_logger])
+        for run_number in range(20):
+            pool.submit(make_run(run_number))
+        pool.shutdown(wait=False)
+
+        # the scheduler published everything before the executor stopped
+        self.assertFalse(pool._scheduler.is_alive())
+        pool._executor.shutdown(wait=True)
+        self.assertEqual(run_logger.seen, list(range(20)))
+        self.assertFalse(run_logger.flushed)
+
+    def test_backlog_goes_to_batch_log_runs(self):
+        loggers = [BatchingLogger(delay=0.05), OptedOutLogger(delay=0.05)]
+        pool = DAQLoggerPool(loggers)
+        for run_number in range(5):
+            pool.submit(make_run(run_number))
+        pool.join()
+
+        for run_logger in loggers:
+            self.assertEqual(run_logger.seen, list(range(5)))
+        self.assertTrue(loggers[0].batches)
+        self.assertEqual(loggers[1].batches, [])
+        pool.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()